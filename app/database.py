@@ -1,9 +1,17 @@
-from pymongo import MongoClient, ASCENDING, DESCENDING
-from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
-from datetime import datetime, timedelta
+from motor.motor_asyncio import AsyncIOMotorClient
+from bson import json_util
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError, OperationFailure
+from pymongo.write_concern import WriteConcern
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 import os
 from dotenv import load_dotenv
+from fastapi import Request
 import logging
+import asyncio
+import time
+import aiofiles
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -11,14 +19,41 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# Días que se conservan logs, alertas resueltas y lecturas de calidad (índices TTL)
+DATA_RETENTION_DAYS = int(os.getenv("DATA_RETENTION_DAYS", "30"))
+
+# Segundos durante los que se reutilizan las estadísticas de la base de datos
+STATS_CACHE_SECONDS = 10
+
+# Colecciones de telemetría que se escriben sin confirmación del servidor
+UNACKNOWLEDGED_COLLECTIONS = {"usage_logs", "device_status", "water_quality"}
+
+# Documentos leídos del cursor y escritos a disco por lote al respaldar
+BACKUP_BATCH_SIZE = 1000
+
 class DatabaseManager:
     def __init__(self):
         self.client = None
         self.db = None
         self.collections = {}
+        self._index_task = None
+        self._index_errors = []
+        self._ready_indexes = set()  # (colección, índice) confirmados en el servidor
+        self._stats_cache = None
         self._connect()
         self._setup_collections()
-        self._create_indexes()
+    
+    async def initialize(self):
+        """Verifica la conexión y lanza la creación de índices (se llama al arrancar la app)"""
+        try:
+            await self.client.admin.command('ping')
+            logger.info("✅ Conexión exitosa a MongoDB")
+        except (ConnectionFailure, ServerSelectionTimeoutError) as e:
+            # Motor reintenta la conexión en cada operación; la app puede arrancar igual
+            logger.error("❌ Error conectando a MongoDB: %s", e)
+        
+        # Los índices se crean en segundo plano para no retrasar el arranque
+        self._index_task = asyncio.create_task(self._create_indexes())
     
     def _connect(self):
         """Establece conexión con MongoDB"""
@@ -27,31 +62,41 @@ class DatabaseManager:
             if not mongo_uri:
                 raise ValueError("MONGO_URI no encontrada en variables de entorno")
             
-            self.client = MongoClient(
+            # Cada conexión del pool es un socket abierto en mongod: el total
+            # (maxPoolSize x workers x réplicas de la app) debe quedar por debajo
+            # de net.maxIncomingConnections y del `ulimit -n` del servidor.
+            self.client = AsyncIOMotorClient(
                 mongo_uri,
                 serverSelectionTimeoutMS=5000,  # 5 segundos timeout
                 connectTimeoutMS=10000,         # 10 segundos para conectar
                 socketTimeoutMS=20000,          # 20 segundos para operaciones
-                maxPoolSize=10,                 # Máximo 10 conexiones
+                maxPoolSize=int(os.getenv("MONGO_MAX_POOL", "256")),
+                minPoolSize=int(os.getenv("MONGO_MIN_POOL", "10")),
+                waitQueueTimeoutMS=int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000")),
+                maxIdleTimeMS=60000,            # Reciclar sockets inactivos tras 1 minuto
+                tz_aware=True,                  # Las fechas se leen como datetime UTC con zona
                 retryWrites=True
             )
             
-            # Verificar conexión
-            self.client.admin.command('ping')
+            # La conexión real se verifica en initialize(); Motor conecta de forma perezosa
             self.db = self.client["smartwater_system"]
-            logger.info("✅ Conexión exitosa a MongoDB")
             
-        except (ConnectionFailure, ServerSelectionTimeoutError) as e:
-            logger.error(f"❌ Error conectando a MongoDB: {e}")
-            raise
         except Exception as e:
-            logger.error(f"❌ Error inesperado en conexión: {e}")
+            logger.error("❌ Error inesperado en conexión: %s", e)
             raise
     
     def _setup_collections(self):
-        """Configura las colecciones de la base de datos"""
+        """Configura las colecciones de la base de datos.
+
+        usage_logs, device_status y water_quality son telemetría de solo
+        inserción y usan WriteConcern(w=0): el servidor no confirma la escritura,
+        así que ante una caída se pueden perder unos segundos de datos y los
+        errores de inserción no llegan a la app. El resto de colecciones
+        (alertas, configuración, ...) mantiene el write concern de la URI.
+        """
         collection_names = [
             "system_status",
+            "current_status",
             "alerts", 
             "usage_logs",
             "settings",
@@ -63,57 +108,156 @@ class DatabaseManager:
         ]
         
         for name in collection_names:
-            self.collections[name] = self.db[name]
+            if name in UNACKNOWLEDGED_COLLECTIONS:
+                self.collections[name] = self.db.get_collection(
+                    name, write_concern=WriteConcern(w=0)
+                )
+            else:
+                self.collections[name] = self.db[name]
         
-        logger.info(f"✅ Colecciones configuradas: {collection_names}")
+        logger.info("✅ Colecciones configuradas: %s", collection_names)
     
-    def _create_indexes(self):
-        """Crea índices para optimizar consultas"""
+    async def _create_indexes(self):
+        """Crea los índices que todavía no existen.
+
+        Cada índice se crea o elimina por separado: un fallo (p. ej. collMod sin
+        privilegios) se registra y el resto de la pasada continúa, porque la
+        retención de datos depende de los índices TTL.
+        """
+        self._index_errors = []
         try:
+            # Un listIndexes por colección, en paralelo; solo se crean los que faltan
+            names = ["system_status", "alerts", "usage_logs", "device_status",
+                     "maintenance_records", "water_quality"]
+            existing = dict(zip(names, await asyncio.gather(
+                *(self._list_indexes(name) for name in names)
+            )))
+            self._ready_indexes = {
+                (collection_name, name)
+                for collection_name, indexes in existing.items() for name in indexes
+            }
+            
             # Índices para system_status
-            self.collections["system_status"].create_index([
+            await self._ensure_index(existing, "system_status", "last_updated_-1", [
                 ("last_updated", DESCENDING)
             ])
             
-            # Índices para alerts
-            self.collections["alerts"].create_index([
-                ("timestamp", DESCENDING),
-                ("resolved", ASCENDING)
+            # Índices para alerts: el listado sin filtro solo ordena por timestamp
+            await self._drop_index(existing, "alerts", "timestamp_-1_resolved_1")
+            await self._ensure_index(existing, "alerts", "timestamp_-1", [
+                ("timestamp", DESCENDING)
             ])
-            self.collections["alerts"].create_index([
+            # Índice parcial solo con alertas abiertas: se mantiene pequeño aunque
+            # la colección crezca con alertas resueltas. Sustituye al compuesto
+            # resolved_1_timestamp_-1, que indexaba todas las alertas.
+            await self._drop_index(existing, "alerts", "resolved_1_timestamp_-1")
+            await self._ensure_index(existing, "alerts", "unresolved_ts", [
+                ("timestamp", DESCENDING)
+            ], partialFilterExpression={"resolved": False})
+            await self._ensure_index(existing, "alerts", "alert_type_1_component_1", [
                 ("alert_type", ASCENDING),
                 ("component", ASCENDING)
             ])
             
-            # Índices para usage_logs
-            self.collections["usage_logs"].create_index([
-                ("timestamp", DESCENDING)
-            ])
-            self.collections["usage_logs"].create_index([
+            # Los índices TTL sustituyen a las limpiezas periódicas: mongod
+            # elimina los documentos vencidos en segundo plano.
+            retention_seconds = DATA_RETENTION_DAYS * 86400
+            
+            await self._ensure_index(existing, "alerts", "timestamp_1", [
+                ("timestamp", ASCENDING)
+            ], expireAfterSeconds=retention_seconds,
+               partialFilterExpression={"resolved": True})
+            
+            # Índices para usage_logs (el TTL sustituye al antiguo timestamp_-1)
+            await self._drop_index(existing, "usage_logs", "timestamp_-1")
+            await self._ensure_index(existing, "usage_logs", "timestamp_1", [
+                ("timestamp", ASCENDING)
+            ], expireAfterSeconds=retention_seconds)
+            # Solo se consultan por acción los llenados completados
+            await self._drop_index(existing, "usage_logs", "action_1_timestamp_-1")
+            await self._ensure_index(existing, "usage_logs", "fill_complete_timestamp", [
                 ("action", ASCENDING),
                 ("timestamp", DESCENDING)
-            ])
+            ], partialFilterExpression={"action": "fill_complete"})
             
             # Índices para device_status
-            self.collections["device_status"].create_index([
+            await self._ensure_index(existing, "device_status", "device_id_1_last_seen_-1", [
                 ("device_id", ASCENDING),
                 ("last_seen", DESCENDING)
             ])
             
             # Índices para maintenance_records
-            self.collections["maintenance_records"].create_index([
+            await self._ensure_index(existing, "maintenance_records", "date_-1", [
                 ("date", DESCENDING)
             ])
             
-            # Índices para water_quality
-            self.collections["water_quality"].create_index([
-                ("timestamp", DESCENDING)
-            ])
+            # Índices para water_quality (el TTL sustituye al antiguo timestamp_-1)
+            await self._drop_index(existing, "water_quality", "timestamp_-1")
+            await self._ensure_index(existing, "water_quality", "timestamp_1", [
+                ("timestamp", ASCENDING)
+            ], expireAfterSeconds=retention_seconds)
             
-            logger.info("✅ Índices creados exitosamente")
+            if self._index_errors:
+                logger.error("❌ Índices con errores: %s", self._index_errors)
+            else:
+                logger.info("✅ Índices verificados exitosamente")
             
         except Exception as e:
-            logger.error(f"❌ Error creando índices: {e}")
+            logger.error("❌ Error creando índices: %s", e)
+    
+    async def _list_indexes(self, collection_name: str) -> dict:
+        """Índices existentes en una colección: nombre -> especificación"""
+        cursor = self.db[collection_name].list_indexes()
+        return {index["name"]: index async for index in cursor}
+    
+    async def _ensure_index(self, existing: dict, collection_name: str, name: str, keys: list, **options):
+        """Crea un índice solo si no existe uno con el mismo nombre.
+
+        En los índices TTL ya existentes se actualiza expireAfterSeconds con
+        collMod si DATA_RETENTION_DAYS cambió desde que se crearon.
+        """
+        current = existing[collection_name].get(name)
+        try:
+            if current is not None:
+                expire = options.get("expireAfterSeconds")
+                if expire is not None and current.get("expireAfterSeconds") != expire:
+                    # collMod requiere un privilegio que el rol readWrite no incluye
+                    await self.db.command("collMod", collection_name, index={
+                        "name": name, "expireAfterSeconds": expire
+                    })
+                    logger.info("✅ Retención de '%s' en '%s' actualizada a %s segundos",
+                                name, collection_name, expire)
+                return
+            # self.db[...] usa el write concern por defecto aunque la colección sea w=0
+            await self.db[collection_name].create_index(
+                keys, name=name, background=True, **options
+            )
+            self._ready_indexes.add((collection_name, name))
+            logger.info("✅ Índice '%s' creado en '%s'", name, collection_name)
+        except Exception as e:
+            logger.error("❌ Error con el índice '%s' en '%s': %s", name, collection_name, e)
+            self._index_errors.append(f"{collection_name}.{name}")
+    
+    async def _drop_index(self, existing: dict, collection_name: str, index_name: str):
+        """Elimina un índice obsoleto si todavía existe"""
+        if index_name not in existing[collection_name]:
+            return
+        try:
+            await self.db[collection_name].drop_index(index_name)
+            self._ready_indexes.discard((collection_name, index_name))
+            logger.info("✅ Índice obsoleto '%s' eliminado de '%s'", index_name, collection_name)
+        except OperationFailure as e:
+            # IndexNotFound: otro worker ya lo eliminó
+            if e.code != 27:
+                logger.error("❌ Error eliminando el índice '%s' de '%s': %s", index_name, collection_name, e)
+                self._index_errors.append(f"{collection_name}.{index_name}")
+        except Exception as e:
+            logger.error("❌ Error eliminando el índice '%s' de '%s': %s", index_name, collection_name, e)
+            self._index_errors.append(f"{collection_name}.{index_name}")
+    
+    def index_ready(self, collection_name: str, index_name: str) -> bool:
+        """Indica si el índice ya existe; las consultas solo usan hint() en ese caso"""
+        return (collection_name, index_name) in self._ready_indexes
     
     def get_collection(self, name: str):
         """Obtiene una colección específica"""
@@ -121,69 +265,87 @@ class DatabaseManager:
             raise ValueError(f"Colección '{name}' no existe")
         return self.collections[name]
     
-    def health_check(self):
+    async def health_check(self):
         """Verifica el estado de la conexión"""
         try:
-            self.client.admin.command('ping')
+            await self.client.admin.command('ping')
             return True
         except Exception as e:
-            logger.error(f"❌ Health check fallido: {e}")
+            logger.error("❌ Health check fallido: %s", e)
             return False
     
-    def get_database_stats(self):
+    async def _get_collection_stats(self, name: str):
+        """Obtiene count/size/avgObjSize de una colección con $collStats"""
+        try:
+            result = await self.collections[name].aggregate([
+                {"$collStats": {"storageStats": {}}}
+            ]).to_list(length=1)
+            stats = result[0]["storageStats"]
+            return {
+                "count": stats.get("count", 0),
+                "size": stats.get("size", 0),
+                "avgObjSize": stats.get("avgObjSize", 0)
+            }
+        except Exception:
+            return {"count": 0, "size": 0, "avgObjSize": 0}
+    
+    async def get_database_stats(self):
         """Obtiene estadísticas de la base de datos"""
+        # Los dashboards consultan esto a menudo; se reutiliza el resultado unos segundos
+        if self._stats_cache and time.monotonic() - self._stats_cache[0] < STATS_CACHE_SECONDS:
+            return self._stats_cache[1]
+        
         try:
-            db_stats = self.db.command("dbstats")
-            collection_stats = {}
-            
-            for name, collection in self.collections.items():
-                try:
-                    stats = self.db.command("collstats", name)
-                    collection_stats[name] = {
-                        "count": stats.get("count", 0),
-                        "size": stats.get("size", 0),
-                        "avgObjSize": stats.get("avgObjSize", 0)
-                    }
-                except:
-                    collection_stats[name] = {"count": 0, "size": 0, "avgObjSize": 0}
+            # dbStats y las estadísticas de cada colección se piden en paralelo
+            names = list(self.collections)
+            db_stats, *per_collection = await asyncio.gather(
+                self.db.command("dbstats"),
+                *(self._get_collection_stats(name) for name in names)
+            )
             
-            return {
+            stats = {
                 "database": {
                     "collections": db_stats.get("collections", 0),
                     "dataSize": db_stats.get("dataSize", 0),
                     "storageSize": db_stats.get("storageSize", 0),
                     "indexes": db_stats.get("indexes", 0)
                 },
-                "collections": collection_stats
+                "collections": dict(zip(names, per_collection))
             }
+            self._stats_cache = (time.monotonic(), stats)
+            return stats
         except Exception as e:
-            logger.error(f"❌ Error obteniendo estadísticas: {e}")
+            logger.error("❌ Error obteniendo estadísticas: %s", e)
             return None
     
-    def cleanup_old_data(self, days_to_keep: int = 30):
-        """Limpia datos antiguos para mantener la base de datos eficiente"""
+    async def cleanup_old_data(self, days_to_keep: int = DATA_RETENTION_DAYS):
+        """Limpia datos antiguos bajo demanda (la limpieza normal la hacen los índices TTL)"""
+        # Con menos de un día el corte queda en el presente y se borraría todo
+        if days_to_keep < 1:
+            logger.error("❌ Limpieza rechazada: days_to_keep=%s, se requiere al menos 1", days_to_keep)
+            return None
         try:
-            cutoff_date = datetime.now() - timedelta(days=days_to_keep)
+            cutoff_date = datetime.now(timezone.utc) - timedelta(days=days_to_keep)
             
+            # Se usan colecciones con write concern por defecto para obtener deleted_count
             # Limpiar logs antiguos
-            result_logs = self.collections["usage_logs"].delete_many({
+            result_logs = await self.db["usage_logs"].delete_many({
                 "timestamp": {"$lt": cutoff_date}
             })
             
             # Limpiar alertas resueltas antiguas
-            result_alerts = self.collections["alerts"].delete_many({
+            result_alerts = await self.collections["alerts"].delete_many({
                 "timestamp": {"$lt": cutoff_date},
                 "resolved": True
             })
             
             # Limpiar datos de calidad de agua antiguos
-            result_quality = self.collections["water_quality"].delete_many({
+            result_quality = await self.db["water_quality"].delete_many({
                 "timestamp": {"$lt": cutoff_date}
             })
             
-            logger.info(f"✅ Limpieza completada: {result_logs.deleted_count} logs, "
-                       f"{result_alerts.deleted_count} alertas, "
-                       f"{result_quality.deleted_count} registros de calidad eliminados")
+            logger.info("✅ Limpieza completada: %s logs, %s alertas, %s registros de calidad eliminados",
+                        result_logs.deleted_count, result_alerts.deleted_count, result_quality.deleted_count)
             
             return {
                 "logs_deleted": result_logs.deleted_count,
@@ -192,48 +354,159 @@ class DatabaseManager:
             }
             
         except Exception as e:
-            logger.error(f"❌ Error en limpieza: {e}")
+            logger.error("❌ Error en limpieza: %s", e)
             return None
     
-    def backup_collection(self, collection_name: str, backup_path: str = None):
-        """Crea un respaldo de una colección específica"""
+    async def backup_collection(self, collection_name: str, backup_path: str) -> Optional[int]:
+        """Crea un respaldo NDJSON de una colección y devuelve cuántos documentos escribió.
+
+        Los documentos se leen del cursor y se escriben por lotes, sin cargar
+        la colección completa en memoria.
+        """
         try:
             if collection_name not in self.collections:
                 raise ValueError(f"Colección '{collection_name}' no existe")
             
             collection = self.collections[collection_name]
-            data = list(collection.find())
+            cursor = collection.find(batch_size=BACKUP_BATCH_SIZE, no_cursor_timeout=True)
+            count = 0
             
-            if backup_path:
-                import json
-                with open(backup_path, 'w') as f:
-                    json.dump(data, f, default=str, indent=2)
-                logger.info(f"✅ Respaldo de '{collection_name}' guardado en {backup_path}")
+            try:
+                async with aiofiles.open(backup_path, 'w') as f:
+                    lines = []
+                    async for doc in cursor:
+                        lines.append(json_util.dumps(doc) + "\n")
+                        if len(lines) >= BACKUP_BATCH_SIZE:
+                            await f.writelines(lines)
+                            count += len(lines)
+                            lines = []
+                    if lines:
+                        await f.writelines(lines)
+                        count += len(lines)
+            finally:
+                await cursor.close()
             
-            return data
+            logger.info("✅ Respaldo de '%s' guardado en %s (%s documentos)", collection_name, backup_path, count)
+            return count
             
         except Exception as e:
-            logger.error(f"❌ Error creando respaldo: {e}")
+            logger.error("❌ Error creando respaldo: %s", e)
             return None
     
     def close_connection(self):
         """Cierra la conexión a la base de datos"""
+        if self._index_task and not self._index_task.done():
+            self._index_task.cancel()
         if self.client:
             self.client.close()
             logger.info("✅ Conexión cerrada")
 
-# Instancia global del manager
-db_manager = DatabaseManager()
+class BufferedWriter:
+    """Acumula documentos en memoria y los inserta en lote con insert_many.
+
+    El lote se escribe al llegar a `batch_size` documentos o cada
+    `flush_interval` segundos, lo que ocurra primero.
+    """
+
+    def __init__(self, collection, batch_size: int = 100, flush_interval: float = 1.0):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def add(self, document: dict):
+        """Agrega un documento al buffer y escribe el lote si está lleno"""
+        async with self._lock:
+            self._buffer.append(document)
+            if len(self._buffer) < self.batch_size:
+                return
+            batch, self._buffer = self._buffer, []
+        await self._insert(batch)
+
+    async def add_many(self, documents: list):
+        """Agrega varios documentos al buffer de una sola vez"""
+        async with self._lock:
+            self._buffer.extend(documents)
+            if len(self._buffer) < self.batch_size:
+                return
+            batch, self._buffer = self._buffer, []
+        await self._insert(batch)
+
+    async def flush(self):
+        """Escribe inmediatamente los documentos pendientes"""
+        async with self._lock:
+            batch, self._buffer = self._buffer, []
+        if batch:
+            await self._insert(batch)
+
+    async def _insert(self, batch: list):
+        try:
+            # pymongo rechaza bypass_document_validation con write concern w=0
+            await self.collection.insert_many(
+                batch, ordered=False,
+                bypass_document_validation=self.collection.write_concern.acknowledged
+            )
+        except Exception as e:
+            logger.error("❌ Error insertando lote en '%s': %s", self.collection.name, e)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """Inicia el vaciado periódico del buffer"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detiene el vaciado periódico y escribe lo pendiente"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+# Instancia global del manager, creada en el arranque de la app (ver init_db)
+_db_manager: Optional[DatabaseManager] = None
+_db_lock = asyncio.Lock()
+
+async def init_db() -> DatabaseManager:
+    """Crea e inicializa el manager compartido una sola vez"""
+    global _db_manager
+    async with _db_lock:
+        if _db_manager is None:
+            manager = DatabaseManager()
+            await manager.initialize()
+            _db_manager = manager
+    return _db_manager
+
+def get_db_manager() -> DatabaseManager:
+    if _db_manager is None:
+        raise RuntimeError("DatabaseManager no inicializado; llama a init_db() al arrancar")
+    return _db_manager
+
+def get_db(request: Request) -> DatabaseManager:
+    """Dependencia de FastAPI que devuelve el manager compartido de la app"""
+    return request.app.state.db
 
 # Funciones de conveniencia para usar en otros módulos
 def get_collection(name: str):
-    return db_manager.get_collection(name)
+    return get_db_manager().get_collection(name)
+
+def index_ready(collection_name: str, index_name: str) -> bool:
+    return get_db_manager().index_ready(collection_name, index_name)
 
-def health_check():
-    return db_manager.health_check()
+async def health_check():
+    return await get_db_manager().health_check()
 
-def get_stats():
-    return db_manager.get_database_stats()
+async def get_stats():
+    return await get_db_manager().get_database_stats()
 
-def cleanup_old_data(days: int = 30):
-    return db_manager.cleanup_old_data(days)
\ No newline at end of file
+async def cleanup_old_data(days: int = DATA_RETENTION_DAYS):
+    return await get_db_manager().cleanup_old_data(days)
\ No newline at end of file
@@ -1,37 +1,87 @@
-from fastapi import FastAPI, HTTPException
-from models import SystemStatus, Alert, SystemSettings, WaterUsageLog, TankLevel
-from services import water_service
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Query, Request, Response
+from fastapi.responses import ORJSONResponse
+import orjson
+from .models import SystemStatus, SystemSettings, STATUS_ADAPTER, SETTINGS_ADAPTER
+from .database import DatabaseManager, init_db, get_db, DATA_RETENTION_DAYS
+from .services import WaterSystemService, get_water_service
 
-app = FastAPI()
+class MongoJSONResponse(ORJSONResponse):
+    """Respuesta orjson para documentos crudos de MongoDB (ObjectId se serializa como texto)"""
+    
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+def model_json(adapter, value, **kwargs) -> Response:
+    """Serializa un modelo a JSON con su TypeAdapter, sin pasar por response_model"""
+    return Response(adapter.dump_json(value), media_type="application/json", **kwargs)
+
+# Máximo de alertas por consulta
+MAX_ALERTS_LIMIT = 500
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+@app.on_event("startup")
+async def startup():
+    app.state.db = await init_db()
+    get_water_service().start_background_tasks()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await get_water_service().stop_background_tasks()
+    app.state.db.close_connection()
 
 @app.get("/status", response_model=SystemStatus)
-async def get_status():
-    return await water_service.get_current_status()
+async def get_status(request: Request,
+                     water_service: WaterSystemService = Depends(get_water_service)):
+    status = await water_service.get_current_status()
+    if status is None:
+        raise HTTPException(status_code=404, detail="No hay estado registrado")
+    
+    # Cada estado guardado tiene su propio last_updated; sirve como ETag
+    etag = f'"{status.last_updated.timestamp()}"'
+    headers = {"Cache-Control": "max-age=1", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return model_json(STATUS_ADAPTER, status, headers=headers)
 
 @app.post("/status", response_model=SystemStatus)
-async def update_status(status: SystemStatus):
-    return await water_service.update_system_status(status)
+async def update_status(status: SystemStatus, background_tasks: BackgroundTasks,
+                        water_service: WaterSystemService = Depends(get_water_service)):
+    if not await water_service.update_system_status(status, background_tasks):
+        raise HTTPException(status_code=500, detail="Error actualizando estado")
+    return model_json(STATUS_ADAPTER, status)
 
 @app.get("/settings", response_model=SystemSettings)
-async def get_settings():
-    return await water_service.get_system_settings()
+async def get_settings(water_service: WaterSystemService = Depends(get_water_service)):
+    settings = await water_service.get_settings()
+    if settings is None:
+        raise HTTPException(status_code=500, detail="Error obteniendo configuración")
+    return model_json(SETTINGS_ADAPTER, settings)
 
 @app.post("/settings", response_model=SystemSettings)
-async def update_settings(settings: SystemSettings):
-    return await water_service.update_system_settings(settings)
+async def update_settings(settings: SystemSettings, water_service: WaterSystemService = Depends(get_water_service)):
+    if not await water_service.update_settings(settings):
+        raise HTTPException(status_code=500, detail="Error actualizando configuración")
+    return model_json(SETTINGS_ADAPTER, settings)
 
-@app.get("/alerts", response_model=list[Alert])
-async def get_alerts():
-    return await water_service.get_alerts()
+@app.get("/alerts")
+async def get_alerts(limit: int = Query(50, ge=1, le=MAX_ALERTS_LIMIT), unresolved_only: bool = False,
+                     water_service: WaterSystemService = Depends(get_water_service)):
+    # El _id ya llega como texto desde la proyección; la lista se serializa en una sola pasada
+    return MongoJSONResponse(await water_service.get_alerts(limit, unresolved_only))
 
-@app.post("/control/manual", response_model=SystemStatus)
-async def manual_control(pump_on: bool):
-    return await water_service.manual_control(pump_on)
+@app.post("/control/manual")
+async def manual_control(pump_on: bool, water_service: WaterSystemService = Depends(get_water_service)):
+    return await water_service.manual_pump_control("start" if pump_on else "stop")
 
-@app.get("/analytics/usage", response_model=list[WaterUsageLog])
-async def get_usage_analytics():
-    return await water_service.get_usage_analytics()
+@app.get("/analytics/usage")
+async def get_usage_analytics(days: int = Query(7, ge=1), include_logs: bool = False,
+                              water_service: WaterSystemService = Depends(get_water_service)):
+    return MongoJSONResponse(await water_service.get_usage_analytics(days, include_logs))
 
-@app.post("/simulate/scenario", response_model=SystemStatus)
-async def simulate_scenario(tank_level: TankLevel):
-    return await water_service.simulate_scenario(tank_level)
+@app.post("/maintenance/cleanup")
+async def run_cleanup(days: int = Query(DATA_RETENTION_DAYS, ge=1), db: DatabaseManager = Depends(get_db)):
+    result = await db.cleanup_old_data(days)
+    if result is None:
+        raise HTTPException(status_code=500, detail="Error en limpieza de datos")
+    return result
@@ -1,8 +1,12 @@
-from pydantic import BaseModel, Field
-from datetime import datetime
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+from datetime import datetime, timezone
 from typing import Optional, List
 from enum import Enum
 
+def utc_now() -> datetime:
+    """Fecha y hora actual en UTC; MongoDB guarda las fechas como BSON Date en UTC"""
+    return datetime.now(timezone.utc)
+
 class TankLevel(str, Enum):
     EMPTY = "empty"          # 0-10%
     LOW = "low"              # 10-30%
@@ -49,26 +53,24 @@ class SystemStatus(BaseModel):
     ambient_temperature: Optional[float] = Field(default=None, description="Temperatura ambiente en °C")
     
     # Metadata
-    last_updated: datetime = Field(default_factory=datetime.now)
+    last_updated: datetime = Field(default_factory=utc_now)
     system_mode: SystemMode = Field(default=SystemMode.AUTOMATIC)
     
-    class Config:
-        use_enum_values = True
+    model_config = ConfigDict(use_enum_values=True)
 
 class Alert(BaseModel):
     message: str
     alert_type: AlertType
     component: str = Field(description="bomba, tinaco, cisterna, sistema, sensor")
     severity_level: int = Field(ge=1, le=5, default=3, description="Nivel de severidad 1-5")
-    timestamp: datetime = Field(default_factory=datetime.now)
+    timestamp: datetime = Field(default_factory=utc_now)
     resolved: bool = Field(default=False)
     resolved_at: Optional[datetime] = None
     resolved_by: Optional[str] = None
     auto_generated: bool = Field(default=True)
     requires_action: bool = Field(default=False)
     
-    class Config:
-        use_enum_values = True
+    model_config = ConfigDict(use_enum_values=True)
 
 class SystemSettings(BaseModel):
     # Configuración básica
@@ -110,11 +112,10 @@ class SystemSettings(BaseModel):
     pressure_monitoring: bool = Field(default=False)
     leak_detection_sensitivity: float = Field(default=0.8, ge=0.1, le=1.0)
     
-    class Config:
-        use_enum_values = True
+    model_config = ConfigDict(use_enum_values=True)
 
 class WaterUsageLog(BaseModel):
-    timestamp: datetime = Field(default_factory=datetime.now)
+    timestamp: datetime = Field(default_factory=utc_now)
     action: str = Field(description="fill_start, fill_complete, manual_start, manual_stop, alert_generated, etc.")
     
     # Estados antes y después
@@ -136,22 +137,21 @@ class WaterUsageLog(BaseModel):
     efficiency_score: Optional[float] = Field(default=None, ge=0, le=1, description="Eficiencia de la operación")
     notes: Optional[str] = None
     
-    class Config:
-        use_enum_values = True
+    model_config = ConfigDict(use_enum_values=True)
 
 class DeviceStatus(BaseModel):
     """Estado de los dispositivos IoT conectados"""
     device_id: str
     device_type: str = Field(description="sensor_nivel, bomba_relay, flow_sensor, etc.")
     online: bool = Field(default=True)
-    last_seen: datetime = Field(default_factory=datetime.now)
+    last_seen: datetime = Field(default_factory=utc_now)
     battery_level: Optional[float] = Field(default=None, ge=0, le=100)
     signal_strength: Optional[float] = Field(default=None, ge=0, le=100, description="Fuerza de señal WiFi/cellular")
     firmware_version: Optional[str] = None
     
 class MaintenanceRecord(BaseModel):
     """Registro de mantenimiento del sistema"""
-    date: datetime = Field(default_factory=datetime.now)
+    date: datetime = Field(default_factory=utc_now)
     maintenance_type: str = Field(description="preventivo, correctivo, limpieza, calibracion")
     component: str = Field(description="bomba, sensores, tuberia, electricidad")
     description: str
@@ -162,7 +162,7 @@ class MaintenanceRecord(BaseModel):
     
 class WaterQuality(BaseModel):
     """Datos de calidad del agua (si se tienen sensores)"""
-    timestamp: datetime = Field(default_factory=datetime.now)
+    timestamp: datetime = Field(default_factory=utc_now)
     ph_level: Optional[float] = Field(default=None, ge=0, le=14)
     turbidity: Optional[float] = Field(default=None, ge=0, description="NTU")
     chlorine_level: Optional[float] = Field(default=None, ge=0, description="mg/L")
@@ -187,7 +187,7 @@ class APIResponse(BaseModel):
     success: bool
     message: str
     data: Optional[dict] = None
-    timestamp: datetime = Field(default_factory=datetime.now)
+    timestamp: datetime = Field(default_factory=utc_now)
     
 class SystemHealth(BaseModel):
     """Estado general de salud del sistema"""
@@ -198,4 +198,9 @@ class SystemHealth(BaseModel):
     critical_alerts_count: int = Field(default=0)
     system_efficiency: float = Field(ge=0, le=1, description="Eficiencia general del sistema")
     components_status: dict = Field(default_factory=dict)
-    last_health_check: datetime = Field(default_factory=datetime.now)
\ No newline at end of file
+    last_health_check: datetime = Field(default_factory=utc_now)
+
+# Adaptadores compilados una sola vez para los modelos que se serializan en cada petición
+STATUS_ADAPTER = TypeAdapter(SystemStatus)
+SETTINGS_ADAPTER = TypeAdapter(SystemSettings)
+ALERT_ADAPTER = TypeAdapter(Alert)
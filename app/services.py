@@ -1,44 +1,211 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import List, Optional, Dict, Any
 import logging
+from fastapi import BackgroundTasks
 from .models import *
-from .database import get_collection
+from .database import get_collection, index_ready, BufferedWriter
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
 import asyncio
+import time
 
 logger = logging.getLogger(__name__)
 
+# Los documentos leídos de MongoDB los escribió este servicio ya validados;
+# con False se vuelven a validar al leerlos
+TRUST_DB = True
+
+def _from_db(model, doc: dict):
+    """Construye un modelo a partir de un documento de MongoDB"""
+    if TRUST_DB:
+        return model.model_construct(**doc)
+    return model.model_validate(doc)
+
+def _build_alert_doc(message: str, alert_type: AlertType, component: str,
+                     severity: int = 3, timestamp: Optional[datetime] = None) -> dict:
+    """Documento de alerta listo para insertar.
+
+    Los datos los genera el propio servicio, así que el modelo se construye sin
+    validar. El _id se asigna aquí para poder devolverlo antes de que el lote
+    se escriba.
+    """
+    alert = Alert.model_construct(
+        message=message,
+        alert_type=alert_type,
+        component=component,
+        severity_level=severity,
+        timestamp=timestamp or utc_now()
+    )
+    return {"_id": ObjectId(), **ALERT_ADAPTER.dump_python(alert)}
+
+# Reglas de alertas: (condición, mensaje, tipo, componente, severidad).
+# Condición y mensaje reciben (status, settings).
+ALERT_RULES = [
+    # Alerta crítica: Cisterna vacía
+    (lambda s, cfg: s.cisterna_level == TankLevel.EMPTY,
+     lambda s, cfg: "⚠️ CRÍTICO: Cisterna vacía - Revisar suministro de agua",
+     AlertType.CRITICAL, "cisterna", 5),
+    
+    # Alerta de bomba funcionando demasiado tiempo
+    (lambda s, cfg: s.bomba_runtime_minutes > cfg.max_pump_runtime_minutes,
+     lambda s, cfg: f"⚠️ Bomba funcionando {s.bomba_runtime_minutes} minutos - Posible fuga o obstrucción",
+     AlertType.ERROR, "bomba", 4),
+    
+    # Alerta de tinaco bajo
+    (lambda s, cfg: (s.tinaco_level == TankLevel.LOW and
+                     s.cisterna_level != TankLevel.EMPTY and
+                     s.bomba_status == PumpStatus.OFF),
+     lambda s, cfg: "Nivel de tinaco bajo - Llenado requerido",
+     AlertType.WARNING, "tinaco", 3),
+    
+    # Alerta de consumo energético alto (kWh)
+    (lambda s, cfg: s.daily_power_consumption > 5.0,
+     lambda s, cfg: f"Consumo energético alto: {s.daily_power_consumption:.2f} kWh hoy",
+     AlertType.WARNING, "energia", 3),
+    
+    # Alerta de flujo bajo
+    (lambda s, cfg: (s.bomba_status == PumpStatus.ON and
+                     s.water_flow_rate < cfg.flow_rate_threshold),
+     lambda s, cfg: f"Flujo de agua bajo: {s.water_flow_rate:.1f} L/min",
+     AlertType.WARNING, "bomba", 3),
+]
+
+# Segundos durante los que se reutiliza la configuración leída de MongoDB; un
+# change stream la invalida antes si otro worker la modifica
+SETTINGS_CACHE_SECONDS = 30
+
+# Espera antes de reabrir el change stream de configuración tras un error de red
+SETTINGS_WATCH_RETRY_SECONDS = 5
+
+# Segundos durante los que se reutiliza el último estado (los dashboards lo consultan cada segundo)
+STATUS_CACHE_SECONDS = 1.0
+
+# _id del único documento de current_status
+CURRENT_STATUS_ID = "current"
+
+# Segundos mínimos entre dos registros del historial de estados (system_status)
+STATUS_HISTORY_SECONDS = 60
+
+# Campos que necesita el listado de alertas; Mongo entrega el _id ya como texto (MongoDB 4.4+)
+ALERT_LIST_PROJECTION = {
+    "_id": {"$toString": "$_id"},
+    "message": 1,
+    "alert_type": 1,
+    "component": 1,
+    "severity_level": 1,
+    "timestamp": 1,
+    "resolved": 1
+}
+
 class WaterSystemService:
     """Servicio principal para la lógica del sistema de agua"""
     
     def __init__(self):
         self.status_collection = get_collection("system_status")
+        self.current_collection = get_collection("current_status")
         self.alerts_collection = get_collection("alerts")
         self.logs_collection = get_collection("usage_logs")
         self.settings_collection = get_collection("settings")
         self.devices_collection = get_collection("device_status")
+        self._settings_cache = None  # (instante monotónico, SystemSettings)
+        self._status_cache = None  # (instante monotónico, SystemStatus)
+        self._settings_watch_task = None
+        self._last_history_ts = float("-inf")
+        
+        # Alertas y logs se escriben en lote (usage_logs ya usa w=0, ver DatabaseManager)
+        self.alerts_writer = BufferedWriter(self.alerts_collection)
+        self.logs_writer = BufferedWriter(self.logs_collection)
+    
+    def start_background_tasks(self):
+        """Inicia los buffers de escritura y la vigilancia de la configuración"""
+        self.alerts_writer.start()
+        self.logs_writer.start()
+        if self._settings_watch_task is None:
+            self._settings_watch_task = asyncio.create_task(self._watch_settings())
+    
+    async def stop_background_tasks(self):
+        """Detiene las tareas de fondo y guarda lo pendiente en los buffers"""
+        if self._settings_watch_task:
+            self._settings_watch_task.cancel()
+            try:
+                await self._settings_watch_task
+            except asyncio.CancelledError:
+                pass
+            self._settings_watch_task = None
+        await self.alerts_writer.stop()
+        await self.logs_writer.stop()
+    
+    async def _watch_settings(self):
+        """Invalida la caché de configuración cuando cambia en MongoDB (cualquier worker)"""
+        while True:
+            try:
+                async with self.settings_collection.watch() as stream:
+                    async for _ in stream:
+                        self._settings_cache = None
+            except OperationFailure as e:
+                # Sin replica set no hay change streams: queda solo el TTL de la caché
+                logger.warning("Change stream de configuración no disponible: %s", e)
+                return
+            except PyMongoError as e:
+                logger.warning("Change stream de configuración interrumpido: %s", e)
+                self._settings_cache = None
+                await asyncio.sleep(SETTINGS_WATCH_RETRY_SECONDS)
         
     async def get_current_status(self) -> Optional[SystemStatus]:
         """Obtiene el estado actual del sistema"""
+        if self._status_cache and time.monotonic() - self._status_cache[0] < STATUS_CACHE_SECONDS:
+            return self._status_cache[1]
+        
         try:
-            latest = self.status_collection.find_one(
-                sort=[("last_updated", -1)]
-            )
+            latest = await self._get_current_status_doc()
             if latest:
-                latest.pop("_id", None)
-                return SystemStatus(**latest)
+                status = _from_db(SystemStatus, latest)
+                self._status_cache = (time.monotonic(), status)
+                return status
             return None
         except Exception as e:
-            logger.error(f"Error obteniendo estado actual: {e}")
+            logger.error("Error obteniendo estado actual: %s", e)
             return None
     
-    async def update_system_status(self, status: SystemStatus) -> bool:
-        """Actualiza el estado del sistema y aplica lógica de control"""
+    async def _get_current_status_doc(self) -> Optional[Dict[str, Any]]:
+        """Documento crudo del estado actual, sin _id (el del historial se valida)"""
+        # Lectura por clave primaria del documento de estado actual
+        latest = await self.current_collection.find_one(
+            {"_id": CURRENT_STATUS_ID}, projection={"_id": 0}
+        )
+        if latest is None:
+            # Bases anteriores al documento "current": usar el último del historial
+            latest = await self.status_collection.find_one(
+                sort=[("last_updated", -1)],
+                projection={"_id": 0}
+            )
+            if latest is not None:
+                # El historial puede tener documentos antiguos con fechas como
+                # texto: se validan y normalizan antes de usarlos sin validar
+                latest = STATUS_ADAPTER.dump_python(SystemStatus.model_validate(latest))
+        return latest
+    
+    async def update_system_status(self, status: SystemStatus,
+                                   background_tasks: Optional[BackgroundTasks] = None) -> bool:
+        """Actualiza el estado del sistema y aplica lógica de control.
+
+        Si se recibe `background_tasks`, la generación de alertas y el registro
+        de actividad se ejecutan después de enviar la respuesta.
+        """
         try:
-            # Insertar nuevo estado
-            result = self.status_collection.insert_one(status.dict())
+            doc = STATUS_ADAPTER.dump_python(status)
+            
+            # El estado actual se sobrescribe en un único documento
+            await self.current_collection.replace_one(
+                {"_id": CURRENT_STATUS_ID}, doc, upsert=True
+            )
+            self._status_cache = None
             
-            if not result.inserted_id:
-                return False
+            # El historial se guarda como mucho una vez por intervalo
+            now = time.monotonic()
+            if now - self._last_history_ts >= STATUS_HISTORY_SECONDS:
+                await self.status_collection.insert_one(doc)
+                self._last_history_ts = now
             
             # Obtener configuración actual
             settings = await self.get_settings()
@@ -49,36 +216,47 @@ class WaterSystemService:
             if settings.auto_mode_enabled:
                 await self._apply_automatic_control(status, settings)
             
-            # Verificar y generar alertas
-            await self._check_and_generate_alerts(status, settings)
-            
-            # Registrar actividad
-            await self._log_activity("status_update", status)
+            if background_tasks is not None:
+                background_tasks.add_task(self._check_and_generate_alerts, status, settings)
+                background_tasks.add_task(self._log_activity, "status_update", status)
+            else:
+                # Verificar y generar alertas
+                await self._check_and_generate_alerts(status, settings)
+                
+                # Registrar actividad
+                await self._log_activity("status_update", status)
             
             return True
             
         except Exception as e:
-            logger.error(f"Error actualizando estado: {e}")
+            logger.error("Error actualizando estado: %s", e)
             return False
     
     async def get_settings(self) -> Optional[SystemSettings]:
         """Obtiene la configuración actual del sistema"""
+        if self._settings_cache and time.monotonic() - self._settings_cache[0] < SETTINGS_CACHE_SECONDS:
+            return self._settings_cache[1]
+        
         try:
-            settings_doc = self.settings_collection.find_one()
+            settings_doc = await self.settings_collection.find_one(projection={"_id": 0})
             if settings_doc:
-                settings_doc.pop("_id", None)
-                return SystemSettings(**settings_doc)
-            return SystemSettings()  # Configuración por defecto
+                settings = _from_db(SystemSettings, settings_doc)
+            else:
+                settings = SystemSettings()  # Configuración por defecto
+            
+            self._settings_cache = (time.monotonic(), settings)
+            return settings
         except Exception as e:
-            logger.error(f"Error obteniendo configuración: {e}")
+            logger.error("Error obteniendo configuración: %s", e)
             return None
     
     async def update_settings(self, settings: SystemSettings) -> bool:
         """Actualiza la configuración del sistema"""
         try:
-            result = self.settings_collection.replace_one(
-                {}, settings.dict(), upsert=True
+            result = await self.settings_collection.replace_one(
+                {}, SETTINGS_ADAPTER.dump_python(settings), upsert=True
             )
+            self._settings_cache = None
             
             # Registrar cambio de configuración
             await self.create_alert(
@@ -89,111 +267,121 @@ class WaterSystemService:
             
             return result.acknowledged
         except Exception as e:
-            logger.error(f"Error actualizando configuración: {e}")
+            logger.error("Error actualizando configuración: %s", e)
             return False
     
     async def create_alert(self, message: str, alert_type: AlertType, 
                           component: str, severity: int = 3) -> Optional[str]:
         """Crea una nueva alerta"""
         try:
-            alert = Alert(
-                message=message,
-                alert_type=alert_type,
-                component=component,
-                severity_level=severity
-            )
+            doc = _build_alert_doc(message, alert_type, component, severity)
+            await self.alerts_writer.add(doc)
             
-            result = self.alerts_collection.insert_one(alert.dict())
-            
-            if result.inserted_id:
-                logger.info(f"Alerta creada: {message}")
-                return str(result.inserted_id)
-            return None
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Alerta creada: %s", message)
+            return str(doc["_id"])
             
         except Exception as e:
-            logger.error(f"Error creando alerta: {e}")
+            logger.error("Error creando alerta: %s", e)
             return None
     
     async def get_alerts(self, limit: int = 50, unresolved_only: bool = False) -> List[Dict]:
-        """Obtiene las alertas del sistema"""
+        """Obtiene las alertas del sistema con el _id convertido a texto por el servidor"""
         try:
             query = {}
             if unresolved_only:
                 query["resolved"] = False
             
-            cursor = self.alerts_collection.find(query).sort("timestamp", -1).limit(limit)
-            alerts = []
-            
-            for alert in cursor:
-                alert["_id"] = str(alert["_id"])
-                alerts.append(alert)
-            
-            return alerts
+            # Sin hint: el planificador elige unresolved_ts (parcial) para las
+            # alertas abiertas y timestamp_-1 para el listado completo
+            cursor = self.alerts_collection.find(
+                query, projection=ALERT_LIST_PROJECTION
+            ).sort("timestamp", -1).limit(limit)
+            return await cursor.to_list(length=limit)
         except Exception as e:
-            logger.error(f"Error obteniendo alertas: {e}")
+            logger.error("Error obteniendo alertas: %s", e)
             return []
     
     async def resolve_alert(self, alert_id: str, resolved_by: str = "system") -> bool:
         """Marca una alerta como resuelta"""
         try:
-            from bson import ObjectId
-            result = self.alerts_collection.update_one(
+            result = await self.alerts_collection.update_one(
                 {"_id": ObjectId(alert_id)},
                 {
                     "$set": {
                         "resolved": True,
-                        "resolved_at": datetime.now(),
+                        "resolved_at": datetime.now(timezone.utc),
                         "resolved_by": resolved_by
                     }
                 }
             )
             return result.modified_count > 0
         except Exception as e:
-            logger.error(f"Error resolviendo alerta: {e}")
+            logger.error("Error resolviendo alerta: %s", e)
             return False
     
-    async def get_usage_analytics(self, days: int = 7) -> Dict[str, Any]:
+    async def get_usage_analytics(self, days: int = 7, include_logs: bool = False) -> Dict[str, Any]:
         """Obtiene análisis de uso de agua"""
         try:
-            start_date = datetime.now() - timedelta(days=days)
-            
-            # Obtener logs del período
-            logs_cursor = self.logs_collection.find({
-                "timestamp": {"$gte": start_date}
-            }).sort("timestamp", -1)
-            
-            logs = list(logs_cursor)
-            
-            # Calcular métricas
-            fill_operations = [log for log in logs if log.get("action") == "fill_complete"]
-            total_fills = len(fill_operations)
-            
-            total_water = sum([
-                log.get("water_amount_liters", 0) 
-                for log in fill_operations 
-                if log.get("water_amount_liters")
-            ])
-            
-            total_duration = sum([
-                log.get("duration_minutes", 0) 
-                for log in fill_operations 
-                if log.get("duration_minutes")
-            ])
-            
-            total_power = sum([
-                log.get("power_consumed_kwh", 0) 
-                for log in fill_operations 
-                if log.get("power_consumed_kwh")
-            ])
-            
-            avg_duration = total_duration / max(total_fills, 1)
-            avg_efficiency = sum([
-                log.get("efficiency_score", 0.8) 
-                for log in fill_operations 
-                if log.get("efficiency_score")
-            ]) / max(total_fills, 1)
+            start_date = datetime.now(timezone.utc) - timedelta(days=days)
+            
+            # Las métricas se calculan en MongoDB; solo viaja un documento resumen
+            pipeline = [
+                {"$match": {
+                    "action": "fill_complete",
+                    "timestamp": {"$gte": start_date}
+                }},
+                {"$group": {
+                    "_id": None,
+                    "total_fills": {"$sum": 1},
+                    "total_water": {"$sum": "$water_amount_liters"},
+                    "total_duration": {"$sum": "$duration_minutes"},
+                    "avg_duration": {"$avg": "$duration_minutes"},
+                    "total_power": {"$sum": "$power_consumed_kwh"},
+                    "avg_efficiency": {"$avg": "$efficiency_score"}
+                }}
+            ]
+            # El índice parcial de fill_complete cubre exactamente este $match.
+            # Solo se fija con hint() cuando ya existe: un hint a un índice
+            # inexistente hace fallar la consulta
+            aggregate_options = {}
+            if index_ready("usage_logs", "fill_complete_timestamp"):
+                aggregate_options["hint"] = "fill_complete_timestamp"
+            summary_query = self.logs_collection.aggregate(
+                pipeline, **aggregate_options
+            ).to_list(length=1)
+            
+            if include_logs:
+                logs_cursor = self.logs_collection.find(
+                    {"timestamp": {"$gte": start_date}},
+                    projection={
+                        "action": 1,
+                        "water_amount_liters": 1,
+                        "duration_minutes": 1,
+                        "timestamp": 1
+                    }
+                ).sort("timestamp", -1).limit(20)
+                if index_ready("usage_logs", "timestamp_1"):
+                    logs_cursor = logs_cursor.hint("timestamp_1")
+                
+                # Resumen y logs recientes se piden a la vez
+                results, recent_logs = await asyncio.gather(
+                    summary_query, logs_cursor.to_list(length=20)
+                )
+            else:
+                results = await summary_query
+            summary = results[0] if results else {}
             
-            return {
+            total_fills = summary.get("total_fills", 0)
+            total_water = summary.get("total_water", 0)
+            total_duration = summary.get("total_duration", 0)
+            total_power = summary.get("total_power", 0)
+            
+            # $avg ignora los logs sin duración o eficiencia registrada
+            avg_duration = summary.get("avg_duration") or 0
+            avg_efficiency = summary.get("avg_efficiency") or 0
+            
+            analytics = {
                 "period_days": days,
                 "total_fills": total_fills,
                 "total_water_liters": round(total_water, 2),
@@ -203,63 +391,73 @@ class WaterSystemService:
                 "average_efficiency": round(avg_efficiency, 2),
                 "fills_per_day": round(total_fills / days, 2),
                 "water_per_day": round(total_water / days, 2),
-                "power_per_day": round(total_power / days, 3),
-                "recent_logs": [
-                    {**log, "_id": str(log["_id"])} 
-                    for log in logs[:20]
-                ]
+                "power_per_day": round(total_power / days, 3)
             }
             
+            if include_logs:
+                analytics["recent_logs"] = recent_logs
+            
+            return analytics
+            
         except Exception as e:
-            logger.error(f"Error obteniendo analytics: {e}")
+            logger.error("Error obteniendo analytics: %s", e)
             return {}
     
     async def manual_pump_control(self, action: str, user: str = "manual") -> Dict[str, Any]:
         """Control manual de la bomba"""
         try:
-            current_status = await self.get_current_status()
-            if not current_status:
+            # Se trabaja sobre el documento crudo: solo cambian dos campos
+            current = await self._get_current_status_doc()
+            if not current:
                 return {"success": False, "message": "No se pudo obtener estado actual"}
             
             if action == "start":
-                if current_status.bomba_status == PumpStatus.ON:
+                if current.get("bomba_status") == PumpStatus.ON:
                     return {"success": False, "message": "La bomba ya está encendida"}
                 
-                current_status.bomba_status = PumpStatus.ON
-                current_status.system_mode = SystemMode.MANUAL
+                current["bomba_status"] = PumpStatus.ON.value
                 message = "Bomba encendida manualmente"
                 
             elif action == "stop":
-                if current_status.bomba_status == PumpStatus.OFF:
+                if current.get("bomba_status") == PumpStatus.OFF:
                     return {"success": False, "message": "La bomba ya está apagada"}
                 
-                current_status.bomba_status = PumpStatus.OFF
-                current_status.system_mode = SystemMode.MANUAL
+                current["bomba_status"] = PumpStatus.OFF.value
                 message = "Bomba apagada manualmente"
                 
             else:
                 return {"success": False, "message": "Acción no válida"}
             
+            current["system_mode"] = SystemMode.MANUAL.value
+            current["last_updated"] = utc_now()
+            
             # Actualizar estado
-            success = await self.update_system_status(current_status)
+            result = await self.current_collection.replace_one(
+                {"_id": CURRENT_STATUS_ID}, current, upsert=True
+            )
+            self._status_cache = None
+            success = result.acknowledged
+            
             if success:
                 await self.create_alert(message, AlertType.INFO, "bomba")
-                await self._log_activity("manual_control", current_status, 
-                                        action_description=f"{action} por {user}")
+                await self._log_activity("manual_control", SystemStatus.model_construct(**current),
+                                        action_description=f"{action} por {user}",
+                                        timestamp=current["last_updated"])
             
             return {
                 "success": success,
                 "message": message,
-                "new_status": current_status.dict()
+                "new_status": current
             }
             
         except Exception as e:
-            logger.error(f"Error en control manual: {e}")
+            logger.error("Error en control manual: %s", e)
             return {"success": False, "message": f"Error: {str(e)}"}
     
     async def _apply_automatic_control(self, status: SystemStatus, settings: SystemSettings):
         """Aplica la lógica de control automático"""
         try:
+            # Las horas pico/preferidas son de reloj local, no UTC
             current_hour = datetime.now().hour
             
             # Verificar si debe encender la bomba
@@ -321,61 +519,32 @@ class WaterSystemService:
                 await self._log_activity("auto_stop", status, action_description=reason)
             
         except Exception as e:
-            logger.error(f"Error en control automático: {e}")
+            logger.error("Error en control automático: %s", e)
     
     async def _check_and_generate_alerts(self, status: SystemStatus, settings: SystemSettings):
         """Verifica el estado y genera alertas necesarias"""
         try:
-            alerts_to_create = []
-            
-            # Alerta crítica: Cisterna vacía
-            if status.cisterna_level == TankLevel.EMPTY:
-                alerts_to_create.append((
-                    "⚠️ CRÍTICO: Cisterna vacía - Revisar suministro de agua",
-                    AlertType.CRITICAL, "cisterna", 5
-                ))
-            
-            # Alerta de bomba funcionando demasiado tiempo
-            if status.bomba_runtime_minutes > settings.max_pump_runtime_minutes:
-                alerts_to_create.append((
-                    f"⚠️ Bomba funcionando {status.bomba_runtime_minutes} minutos - Posible fuga o obstrucción",
-                    AlertType.ERROR, "bomba", 4
-                ))
-            
-            # Alerta de tinaco bajo
-            if (status.tinaco_level == TankLevel.LOW and 
-                status.cisterna_level != TankLevel.EMPTY and
-                status.bomba_status == PumpStatus.OFF):
-                alerts_to_create.append((
-                    "Nivel de tinaco bajo - Llenado requerido",
-                    AlertType.WARNING, "tinaco", 3
-                ))
-            
-            # Alerta de consumo energético alto
-            if status.daily_power_consumption > 5.0:  # kWh
-                alerts_to_create.append((
-                    f"Consumo energético alto: {status.daily_power_consumption:.2f} kWh hoy",
-                    AlertType.WARNING, "energia", 3
-                ))
-            
-            # Alerta de flujo bajo
-            if (status.bomba_status == PumpStatus.ON and 
-                status.water_flow_rate < settings.flow_rate_threshold):
-                alerts_to_create.append((
-                    f"Flujo de agua bajo: {status.water_flow_rate:.1f} L/min",
-                    AlertType.WARNING, "bomba", 3
-                ))
-            
-            # Crear todas las alertas
-            for message, alert_type, component, severity in alerts_to_create:
-                await self.create_alert(message, alert_type, component, severity)
+            alerts_to_create = [
+                (message(status, settings), alert_type, component, severity)
+                for predicate, message, alert_type, component, severity in ALERT_RULES
+                if predicate(status, settings)
+            ]
+            
+            # Crear todas las alertas en un solo lote, con la misma marca de tiempo
+            if alerts_to_create:
+                now = utc_now()
+                await self.alerts_writer.add_many([
+                    _build_alert_doc(message, alert_type, component, severity, now)
+                    for message, alert_type, component, severity in alerts_to_create
+                ])
+                logger.info("Alertas creadas: %s", len(alerts_to_create))
                 
         except Exception as e:
-            logger.error(f"Error verificando alertas: {e}")
+            logger.error("Error verificando alertas: %s", e)
     
     async def _log_activity(self, action: str, status: SystemStatus, 
                            duration: int = None, water_amount: float = None,
-                           action_description: str = None):
+                           action_description: str = None, timestamp: datetime = None):
         """Registra actividad del sistema"""
         try:
             # Para algunas acciones, calcular valores por defecto
@@ -383,7 +552,8 @@ class WaterSystemService:
                 # Estimar agua basada en el cambio de nivel
                 water_amount = (status.tinaco_percentage - 20) * 10  # Estimación simple
             
-            log = WaterUsageLog(
+            # Todos los campos salen de un SystemStatus ya validado: se construye sin validar
+            log = WaterUsageLog.model_construct(
                 action=action,
                 tinaco_level_before=status.tinaco_level,
                 tinaco_level_after=status.tinaco_level,
@@ -394,13 +564,21 @@ class WaterSystemService:
                 power_consumed_kwh=status.power_consumption * (duration or 1) / 60 / 1000 if duration else None,
                 triggered_by="system",
                 operation_mode=status.system_mode,
-                notes=action_description
+                notes=action_description,
+                timestamp=timestamp or utc_now()
             )
             
-            self.logs_collection.insert_one(log.dict())
+            await self.logs_writer.add(log.model_dump())
             
         except Exception as e:
-            logger.error(f"Error registrando actividad: {e}")
+            logger.error("Error registrando actividad: %s", e)
+
+# Instancia global del servicio; se crea después de init_db()
+_water_service: Optional[WaterSystemService] = None
 
-# Instancia global del servicio
-water_service = WaterSystemService()
\ No newline at end of file
+def get_water_service() -> WaterSystemService:
+    """Devuelve el servicio compartido (también sirve como dependencia de FastAPI)"""
+    global _water_service
+    if _water_service is None:
+        _water_service = WaterSystemService()
+    return _water_service
\ No newline at end of file
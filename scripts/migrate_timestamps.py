@@ -0,0 +1,63 @@
+"""Migración única: convierte fechas guardadas como texto a BSON Date.
+
+Los índices TTL y las consultas por rango solo funcionan con BSON Date.
+Los textos que no se pueden interpretar como fecha se dejan como están y se
+informan para corregirlos a mano.
+Uso: python scripts/migrate_timestamps.py
+"""
+from pymongo import MongoClient
+from dotenv import load_dotenv
+import os
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Campos de fecha por colección
+DATE_FIELDS = {
+    "system_status": ["last_updated"],
+    "alerts": ["timestamp", "resolved_at"],
+    "usage_logs": ["timestamp"],
+    "device_status": ["last_seen"],
+    "maintenance_records": ["date", "next_maintenance_due"],
+    "water_quality": ["timestamp"],
+    "system_health": ["last_health_check"],
+    "settings": ["last_maintenance_date"],
+}
+
+def migrate(db):
+    """Reescribe en sitio los campos de texto como fechas; devuelve los documentos modificados"""
+    total = 0
+    for collection_name, fields in DATE_FIELDS.items():
+        for field in fields:
+            # Pipeline de actualización en sitio: conserva los índices de la colección.
+            # $convert con onError conserva el valor original si no es una fecha válida
+            result = db[collection_name].update_many(
+                {field: {"$type": "string"}},
+                [{"$set": {field: {"$convert": {
+                    "input": f"${field}", "to": "date", "onError": f"${field}"
+                }}}}]
+            )
+            if result.modified_count:
+                logger.info("✅ %s.%s: %s documentos convertidos", collection_name, field, result.modified_count)
+            total += result.modified_count
+            
+            invalid = db[collection_name].count_documents({field: {"$type": "string"}})
+            if invalid:
+                logger.warning("⚠️ %s.%s: %s documentos con fechas no válidas sin convertir",
+                               collection_name, field, invalid)
+    return total
+
+if __name__ == "__main__":
+    mongo_uri = os.getenv("MONGO_URI")
+    if not mongo_uri:
+        raise SystemExit("MONGO_URI no encontrada en variables de entorno")
+
+    client = MongoClient(mongo_uri)
+    try:
+        total = migrate(client["smartwater_system"])
+        logger.info("✅ Migración completada: %s documentos convertidos", total)
+    finally:
+        client.close()